@@ -16,7 +16,9 @@
 
 from __future__ import absolute_import, division, with_statement
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from io import BytesIO
 
 import logging
 import signal
@@ -29,6 +31,7 @@ import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
 import tornado.options
+import tornado.process
 import tornado.web
 from tornado.options import define, options, parse_config_file
 
@@ -41,8 +44,15 @@ try:
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
+try:
+    from functools import lru_cache
+except ImportError:  # pragma: no cover
+    def lru_cache(maxsize=128):
+        return lambda f: f
+
 try:
     import pycurl
+    import tornado.curl_httpclient
 except ImportError:
     pycurl = None
 
@@ -96,57 +106,123 @@ define("quality", help="default jpeg quality, 1-99 or keep")
 define("retain", help="default adaptive retain percent, 1-99", type=int)
 define("preserve_exif", help="default behavior for exif data", type=int)
 
+# options copied into the application settings
+_SETTING_KEYS = (
+    "debug", "client_name", "client_key", "allowed_hosts", "max_operations",
+    "max_resize_height", "max_resize_width", "background", "expand",
+    "filter", "format", "mode", "operation", "optimize", "position",
+    "progressive", "quality", "max_requests", "timeout", "implicit_base_url",
+    "ca_certs", "user_agent", "validate_cert", "content_type_from_image",
+    "proxy_host", "proxy_port", "preserve_exif")
+
 logger = logging.getLogger("tornado.application")
 
 
+@lru_cache(maxsize=4096)
+def _cached_verify_signature(key, qs):
+    # Invalid signatures raise rather than return False, because
+    # lru_cache does not store exceptions; only valid queries, which
+    # require the key to produce, are ever cached
+    if not verify_signature(key, qs):
+        raise errors.SignatureError("Invalid signature")
+    return True
+
+
+if pycurl is not None:  # pragma: no cover
+    class _CurlAsyncHTTPClient(tornado.curl_httpclient.CurlAsyncHTTPClient):
+        """Multiplexes concurrent requests to the same host over a single
+        HTTP/2 connection, when supported by the installed libcurl.
+        """
+
+        _HTTP2 = bool(
+            pycurl.version_info()[4] & getattr(pycurl, "VERSION_HTTP2", 0)
+            and hasattr(pycurl, "CURL_HTTP_VERSION_2TLS"))
+
+        def initialize(self, max_clients=10, defaults=None):
+            if self._HTTP2:
+                defaults = dict(defaults or {})
+                defaults.setdefault(
+                    "prepare_curl_callback", self._prepare_curl)
+            super(_CurlAsyncHTTPClient, self).initialize(
+                max_clients=max_clients, defaults=defaults)
+            if self._HTTP2:
+                self._multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+
+        @staticmethod
+        def _prepare_curl(curl):
+            # PIPEWAIT is deliberately not set, it makes requests queue
+            # behind in-flight HTTP/1.1 connections to the same host
+            curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+
+
+def _get_hostname(url):
+    """Returns the lowercase hostname of the url, or None if there is not
+    one. Equivalent to urlparse(url).hostname.
+    """
+    start = url.find("://")
+    if start < 0 or any(c in url[:start] for c in "/?#"):
+        # A "://" after the path has started, e.g. in a relative url's
+        # query string, does not end a scheme
+        return None
+    netloc = url[start + 3:]
+    for c in "/?#":
+        end = netloc.find(c)
+        if end >= 0:
+            netloc = netloc[:end]
+    netloc = netloc.rpartition("@")[2]
+    if netloc.startswith("["):
+        hostname = netloc[1:].partition("]")[0]
+    else:
+        hostname = netloc.partition(":")[0]
+    return hostname.lower() or None
+
+
+class _FormatToMime(dict):
+    """Maps an image format, in any case, to its mime type. Unknown formats
+    map to application/octet-stream.
+    """
+
+    def __missing__(self, key):
+        return self.get(key.lower(), "application/octet-stream")
+
+
 class PilboxApplication(tornado.web.Application):
+    _executor = None
 
     def __init__(self, **kwargs):
-        settings = dict(
-            debug=options.debug,
-            client_name=options.client_name,
-            client_key=options.client_key,
-            allowed_hosts=options.allowed_hosts,
-            allowed_operations=set(
-                options.allowed_operations or ImageHandler.OPERATIONS),
-            max_operations=options.max_operations,
-            max_resize_height=options.max_resize_height,
-            max_resize_width=options.max_resize_width,
-            background=options.background,
-            expand=options.expand,
-            filter=options.filter,
-            format=options.format,
-            mode=options.mode,
-            operation=options.operation,
-            optimize=options.optimize,
-            position=options.position,
-            progressive=options.progressive,
-            quality=options.quality,
-            max_requests=options.max_requests,
-            timeout=options.timeout,
-            implicit_base_url=options.implicit_base_url,
-            ca_certs=options.ca_certs,
-            user_agent=options.user_agent,
-            validate_cert=options.validate_cert,
-            content_type_from_image=options.content_type_from_image,
-            proxy_host=options.proxy_host,
-            proxy_port=options.proxy_port,
-            preserve_exif=options.preserve_exif)
+        settings = dict((k, getattr(options, k)) for k in _SETTING_KEYS)
+        settings["allowed_operations"] = \
+            options.allowed_operations or ImageHandler.OPERATIONS
 
         settings.update(kwargs)
+        settings["allowed_operations"] = frozenset(
+            settings["allowed_operations"])
+        settings["option_defaults"] = ImageHandler.get_option_defaults(
+            settings)
 
         if settings.get("proxy_host") and pycurl is None:  # pragma: no cover
             raise Exception("PycURL is required for proxy requests")
 
         if pycurl is not None:  # pragma: no cover
-            tornado.httpclient.AsyncHTTPClient.configure(
-                "tornado.curl_httpclient.CurlAsyncHTTPClient")
+            tornado.httpclient.AsyncHTTPClient.configure(_CurlAsyncHTTPClient)
 
         tornado.web.Application.__init__(self, self.get_handlers(), **settings)
 
     def get_handlers(self):
         return [(r"/", ImageHandler), ("/ping", LivenessHandler)]
 
+    @property
+    def executor(self):
+        """The thread pool that images are processed on. A single pool,
+        sized to the CPU count, is shared by every application in the
+        process and created on first use, after any worker fork.
+        """
+        if PilboxApplication._executor is None:
+            PilboxApplication._executor = ThreadPoolExecutor(
+                max_workers=tornado.process.cpu_count())
+        return PilboxApplication._executor
+
+
 class LivenessHandler(tornado.web.RequestHandler):
     @tornado.gen.coroutine
     def get(self):
@@ -156,23 +232,72 @@ class ImageHandler(tornado.web.RequestHandler):
     FORWARD_HEADERS = ["Cache-Control", "Expires", "Last-Modified"]
     OPERATIONS = ["region", "resize", "rotate", "noop", "watermark"]
 
-    _FORMAT_TO_MIME = {
+    _FORMAT_TO_MIME = _FormatToMime({
         "gif": "image/gif",
         "jpeg": "image/jpeg",
         "jpg": "image/jpeg",
         "png": "image/png",
         "webp": "image/webp",
         "tiff": "image/tiff",
-    }
+    })
+
+    # Pairs of image option and the request argument that overrides it
+    _RESIZE_ARGUMENTS = (
+        ("mode", "mode"), ("filter", "filter"), ("position", "pos"),
+        ("background", "bg"), ("retain", "retain"))
+    _ROTATE_ARGUMENTS = (("expand", "expand"),)
+    _WATERMARK_ARGUMENTS = (
+        ("watermark_txt", "watermark_txt"),
+        ("watermark_img", "watermark_img"),
+        ("watermark_pos", "watermark_pos"),
+        ("watermark_txt_size", "watermark_txt_size"),
+        ("watermark_txt_color", "watermark_txt_color"),
+        ("watermark_img_ratio", "watermark_img_ratio"))
+    _SAVE_ARGUMENTS = (
+        ("format", "fmt"), ("optimize", "opt"), ("quality", "q"),
+        ("progressive", "prog"), ("background", "bg"),
+        ("preserve_exif", "exif"),
+        ("watermark_pos", "watermark_pos"),
+        ("watermark_txt_size", "watermark_txt_size"),
+        ("watermark_txt_color", "watermark_txt_color"),
+        ("watermark_img_ratio", "watermark_img_ratio"))
+
+    @classmethod
+    def get_option_defaults(cls, settings):
+        """Returns the default value of every image option, taken from the
+        application settings.
+        """
+        arguments = cls._RESIZE_ARGUMENTS + cls._ROTATE_ARGUMENTS \
+            + cls._WATERMARK_ARGUMENTS + cls._SAVE_ARGUMENTS
+        return dict((k, settings.get(k)) for k, _ in arguments)
+
+    def initialize(self):
+        self._allowed_ops = self.settings["allowed_operations"]
+        self._max_ops = self.settings["max_operations"]
+        self._arguments = dict()
+        self._ops = None
+        self._override_content_type = False
+        self._width = None
+        self._height = None
 
     @tornado.gen.coroutine
     def get(self):
         self.validate_request()
         resp = yield self.fetch_image()
-        self.render_image(resp)
+        processed = yield self.process_image(resp)
+        self.render_image(resp, processed)
 
     def get_argument(self, name, default=None, strip=True):
-        return super(ImageHandler, self).get_argument(name, default, strip)
+        if not strip:
+            return super(ImageHandler, self).get_argument(name, default, strip)
+        # Arguments are read repeatedly while validating and processing,
+        # so each is only decoded once per request
+        try:
+            value = self._arguments[name]
+        except KeyError:
+            value = self._arguments[name] = \
+                super(ImageHandler, self).get_argument(name, None)
+        return default if value is None else value
 
     def validate_request(self):
         self._validate_operation()
@@ -181,31 +306,36 @@ class ImageHandler(tornado.web.RequestHandler):
         self._validate_client()
         self._validate_host()
 
-        opts = self._get_save_options()
+        self._override_content_type = bool(
+            self.get_argument("fmt") or self.settings.get("format")
+            or self.settings.get("content_type_from_image"))
+
         ops = self._get_operations()
         if "resize" in ops:
-            w, h = self.get_argument("w"), self.get_argument("h")
+            w = self.get_argument("w")
+            h = self.get_argument("h")
             Image.validate_dimensions(w, h)
-            if w and int(w) > self.settings.get("max_resize_width"):
+            self._width = int(w) if w else None
+            self._height = int(h) if h else None
+            if self._width is not None \
+                    and self._width > self.settings.get("max_resize_width"):
                 raise errors.DimensionsError("Exceeds maximum allowed width")
-            elif h and int(h) > self.settings.get("max_resize_height"):
+            elif self._height is not None \
+                    and self._height > self.settings.get("max_resize_height"):
                 raise errors.DimensionsError("Exceeds maximum allowed height")
-            opts.update(self._get_resize_options())
         if "rotate" in ops:
             Image.validate_degree(self.get_argument("deg"))
-            opts.update(self._get_rotate_options())
         if "region" in ops:
             Image.validate_rectangle(self.get_argument("rect"))
         if "watermark" in ops:
-            url=self.get_argument("watermark_img")
-            text=self.get_argument("watermark_txt")
-            if url and not url.startswith("http://") and not url.startswith("https://"):
-                raise errors.DimensionsError("Unsupported protocol")
-            if text is not None and not text:
-                raise errors.DimensionsError("Watermark text cannot be empty")
-            if text is None and url is None:
-                raise errors.DimensionsError("Watermark requires either watermark_img or watermark_txt")
+            self._validate_watermark()
 
+        # Only build the options once the arguments above are known valid
+        opts = self._get_save_options()
+        if "resize" in ops:
+            opts.update(self._get_resize_options())
+        if "rotate" in ops:
+            opts.update(self._get_rotate_options())
         Image.validate_options(opts)
 
     @tornado.gen.coroutine
@@ -228,17 +358,32 @@ class ImageHandler(tornado.web.RequestHandler):
                 proxy_port=self.settings.get("proxy_port"))
             raise tornado.gen.Return(resp)
         except (socket.gaierror, tornado.httpclient.HTTPError) as e:
-            logger.warn("Fetch error for %s: %s",
-                        self.get_argument("url"),
-                        str(e))
+            logger.warning("Fetch error for %s: %s",
+                           self.get_argument("url"), e)
             raise errors.FetchError()
 
-    def render_image(self, resp):
-        outfile, outfile_format = self._process_response(resp)
+    @tornado.gen.coroutine
+    def process_image(self, resp):
+        if "noop" in self._get_operations():
+            raise tornado.gen.Return(self._process_response(resp))
+        processed = yield tornado.ioloop.IOLoop.current().run_in_executor(
+            self.application.executor, self._process_response, resp)
+        raise tornado.gen.Return(processed)
+
+    def render_image(self, resp, processed=None):
+        # Handlers that do not yield process_image first still process
+        # the image here, on the IOLoop
+        if processed is None:
+            processed = self._process_response(resp)
+        outfile, outfile_format = processed
         self._set_headers(resp.headers, outfile_format)
-        for block in iter(lambda: outfile.read(65536), b""):
-            self.write(block)
-        outfile.close()
+        if isinstance(outfile, BytesIO):
+            # Image.save encodes into a BytesIO, so the whole image is
+            # already in memory and can be written in one call
+            body = outfile.getvalue()
+            outfile.close()
+            outfile = body
+        self.write(outfile)
 
     def write_error(self, status_code, **kwargs):
         err = kwargs["exc_info"][1] if "exc_info" in kwargs else None
@@ -254,7 +399,7 @@ class ImageHandler(tornado.web.RequestHandler):
     def _process_response(self, resp):
         ops = self._get_operations()
         if "noop" in ops:
-            return (resp.buffer, None)
+            return (resp.body, None)
 
         image = Image(resp.buffer)
         for operation in ops:
@@ -274,7 +419,7 @@ class ImageHandler(tornado.web.RequestHandler):
 
     def _image_resize(self, image):
         opts = self._get_resize_options()
-        image.resize(self.get_argument("w"), self.get_argument("h"), **opts)
+        image.resize(self._width, self._height, **opts)
 
     def _image_rotate(self, image):
         opts = self._get_rotate_options()
@@ -289,11 +434,9 @@ class ImageHandler(tornado.web.RequestHandler):
         return image.save(**opts)
 
     def _set_headers(self, headers, file_format):
-        if file_format and any((self.get_argument("fmt"),
-                                self.settings.get("format"),
-                                self.settings.get("content_type_from_image"))):
+        if file_format and self._override_content_type:
             self.set_header(
-                "Content-Type", self._FORMAT_TO_MIME.get(file_format.lower()))
+                "Content-Type", self._FORMAT_TO_MIME[file_format])
         elif "Content-Type" in headers:
             self.set_header("Content-Type", headers["Content-Type"])
 
@@ -302,63 +445,47 @@ class ImageHandler(tornado.web.RequestHandler):
                 self.set_header(k, headers[k])
 
     def _get_operations(self):
-        return self.get_argument(
-            "op", self.settings.get("operation") or "resize").split(",")
+        if self._ops is None:
+            ops = self.get_argument(
+                "op", self.settings.get("operation") or "resize").split(",")
+            # Drop repeated operations, keeping the order they were given
+            self._ops = tuple(sorted(set(ops), key=ops.index))
+        return self._ops
 
     def _get_resize_options(self):
-        return self._get_options(
-            dict(mode=self.get_argument("mode"),
-                 filter=self.get_argument("filter"),
-                 position=self.get_argument("pos"),
-                 background=self.get_argument("bg"),
-                 retain=self.get_argument("retain")))
+        return self._get_options(ImageHandler._RESIZE_ARGUMENTS)
 
     def _get_rotate_options(self):
-        return self._get_options(
-            dict(expand=self.get_argument("expand")))
+        return self._get_options(ImageHandler._ROTATE_ARGUMENTS)
 
     def _get_watermark_options(self):
-        return self._get_options(
-            dict(watermark_txt=self.get_argument("watermark_txt"),
-                 watermark_img=self.get_argument("watermark_img"),
-                 watermark_pos=self.get_argument("watermark_pos"),
-                 watermark_txt_size=self.get_argument("watermark_txt_size"),
-                 watermark_txt_color=self.get_argument("watermark_txt_color"),
-                 watermark_img_ratio=self.get_argument("watermark_img_ratio")))
+        return self._get_options(ImageHandler._WATERMARK_ARGUMENTS)
 
     def _get_save_options(self):
-        return self._get_options(
-            dict(format=self.get_argument("fmt"),
-                 optimize=self.get_argument("opt"),
-                 quality=self.get_argument("q"),
-                 progressive=self.get_argument("prog"),
-                 background=self.get_argument("bg"),
-                 preserve_exif=self.get_argument("exif"),
-                 watermark_pos=self.get_argument("watermark_pos"),
-                 watermark_txt_size=self.get_argument("watermark_txt_size"),
-                 watermark_txt_color=self.get_argument("watermark_txt_color"),
-                 watermark_img_ratio=self.get_argument("watermark_img_ratio")))
-
-    def _get_options(self, opts):
-        for k, v in opts.items():
-            if v is None:
-                opts[k] = self.settings.get(k, None)
+        return self._get_options(ImageHandler._SAVE_ARGUMENTS)
+
+    def _get_options(self, arguments):
+        defaults = self.settings["option_defaults"]
+        opts = dict()
+        for k, name in arguments:
+            v = self.get_argument(name)
+            opts[k] = defaults[k] if v is None else v
         return opts
 
     def _validate_operation(self):
-        operations = set(self._get_operations())
-        if not operations.issubset(self.settings.get("allowed_operations")):
+        operations = self._get_operations()
+        if not self._allowed_ops.issuperset(operations):
             raise errors.OperationError("Unsupported operation")
-        elif len(operations) > self.settings.get("max_operations"):
+        elif len(operations) > self._max_ops:
             raise errors.OperationError("Too many operations")
 
     def _validate_url(self):
         url = self.get_argument("url")
         if not url:
             raise errors.UrlError("Missing url")
-        elif url.startswith("http://") or url.startswith("https://"):
+        elif url.startswith(("http://", "https://")):
             return
-        elif self.settings.get("implicit_base_url") and url.startswith("/"):
+        elif self.settings.get("implicit_base_url") and url[:1] == "/":
             return
         raise errors.UrlError("Unsupported protocol")
 
@@ -369,12 +496,23 @@ class ImageHandler(tornado.web.RequestHandler):
 
     def _validate_signature(self):
         key = self.settings.get("client_key")
-        if key and not verify_signature(key, urlparse(self.request.uri).query):
-            raise errors.SignatureError("Invalid signature")
+        if key:
+            _cached_verify_signature(key, self.request.query)
+
+    def _validate_watermark(self):
+        url = self.get_argument("watermark_img")
+        text = self.get_argument("watermark_txt")
+        if url and not url.startswith(("http://", "https://")):
+            raise errors.DimensionsError("Unsupported protocol")
+        elif text is not None and not text:
+            raise errors.DimensionsError("Watermark text cannot be empty")
+        elif text is None and url is None:
+            raise errors.DimensionsError(
+                "Watermark requires either watermark_img or watermark_txt")
 
     def _validate_host(self):
         hosts = self.settings.get("allowed_hosts", [])
-        if hosts and urlparse(self.get_argument("url")).hostname not in hosts:
+        if hosts and _get_hostname(self.get_argument("url")) not in hosts:
             raise errors.HostError("Invalid host")
 
 
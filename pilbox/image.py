@@ -118,6 +118,10 @@ class Image(object):
             raise errors.DimensionsError("Invalid width: %s" % width)
         elif height and not str(height).isdigit():
             raise errors.DimensionsError("Invalid height: %s" % height)
+        elif width is not None and width != "" and int(width) == 0:
+            raise errors.DimensionsError("Invalid width: %s" % width)
+        elif height is not None and height != "" and int(height) == 0:
+            raise errors.DimensionsError("Invalid height: %s" % height)
 
     @staticmethod
     def validate_degree(deg):
@@ -293,7 +297,7 @@ class Image(object):
                     exif = self.img._getexif() or dict()
                     deg = _orientation_to_rotation.get(exif.get(274, 0), 0)
                 except Exception:
-                    logger.warn('unable to parse exif')
+                    logger.warning('unable to parse exif')
                     deg = 0
             else:
                 deg = 0
@@ -10,10 +10,10 @@ import tornado.gen
 import tornado.ioloop
 import tornado.web
 from tornado.test.util import unittest
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, gen_test
 
 from pilbox import errors
-from pilbox.app import PilboxApplication
+from pilbox.app import PilboxApplication, ImageHandler
 from pilbox.signature import sign
 from pilbox.test import image_test
 
@@ -196,6 +196,29 @@ class _UserAgentHandler(tornado.web.RequestHandler):
         self.finish()
 
 
+class _CustomTestApplication(_PilboxTestApplication):
+    def get_handlers(self):
+        handlers = super(_CustomTestApplication, self).get_handlers()
+        handlers.append((r"/(\d+)x(\d+)/(.+)", _CustomImageHandler))
+        return handlers
+
+
+class _CustomImageHandler(ImageHandler):
+    def prepare(self):
+        self.args = self.request.arguments.copy()
+
+    @tornado.gen.coroutine
+    def get(self, w, h, url):
+        self.args.update(dict(w=w, h=h, url=url))
+
+        self.validate_request()
+        resp = yield self.fetch_image()
+        self.render_image(resp)
+
+    def get_argument(self, name, default=None):
+        return self.args.get(name, default)
+
+
 class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
     def get_app(self):
         return _PilboxTestApplication(timeout=10.0)
@@ -205,6 +228,22 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         resp = self.fetch_error(400, "/?%s" % qs)
         self.assertEqual(resp.get("error_code"), errors.UrlError.get_code())
 
+    def test_shared_executor(self):
+        app = _PilboxTestApplication()
+        self.assertIs(self._app.executor, app.executor)
+
+    @gen_test
+    def test_valid_concurrent(self):
+        cases = self.get_image_rotate_cases()[:4]
+        urls = [self.get_url("/?%s" % urlencode(case["source_query_params"]))
+                for case in cases]
+        responses = yield [self.http_client.fetch(url) for url in urls]
+        for case, resp in zip(cases, responses):
+            self.assertEqual(resp.code, 200)
+            with open(case["expected_path"], "rb") as expected:
+                self.assertEqual(resp.body, expected.read(),
+                                 "%s does not match" % case["expected_path"])
+
     def test_invalid_operation(self):
         qs = urlencode(dict(url="http://foo.co/x.jpg", op="a"))
         resp = self.fetch_error(400, "/?%s" % qs)
@@ -228,6 +267,12 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         self.assertEqual(resp.get("error_code"),
                          errors.DimensionsError.get_code())
 
+    def test_invalid_zero_dimensions(self):
+        qs = urlencode(dict(url="http://foo.co/x.jpg", w=0, h=0))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"),
+                         errors.DimensionsError.get_code())
+
     def test_invalid_height(self):
         qs = urlencode(dict(url="http://foo.co/x.jpg", w=1, h="a"))
         resp = self.fetch_error(400, "/?%s" % qs)
@@ -250,6 +295,26 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         self.assertEqual(resp.get("error_code"),
                          errors.RectangleError.get_code())
 
+    def test_invalid_watermark_protocol(self):
+        qs = urlencode(dict(url="http://foo.co/x.jpg", op="watermark",
+                            watermark_img="file:///x.png"))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"),
+                         errors.DimensionsError.get_code())
+
+    def test_empty_watermark_text(self):
+        qs = urlencode(dict(url="http://foo.co/x.jpg", op="watermark",
+                            watermark_txt=""))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"),
+                         errors.DimensionsError.get_code())
+
+    def test_missing_watermark(self):
+        qs = urlencode(dict(url="http://foo.co/x.jpg", op="watermark"))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"),
+                         errors.DimensionsError.get_code())
+
     def test_invalid_mode(self):
         qs = urlencode(dict(url="http://foo.co/x.jpg", w=1, h=1, mode="foo"))
         resp = self.fetch_error(400, "/?%s" % qs)
@@ -354,6 +419,29 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         with open(expected_path, "rb") as expected:
             self.assertEqual(resp.buffer.read(), expected.read(), msg)
 
+    def test_valid_cache_headers(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=10, h=10))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.headers.get("Content-Length"),
+                         str(len(resp.body)))
+        self.assertNotIn("Transfer-Encoding", resp.headers)
+        etag = resp.headers.get("Etag")
+        self.assertTrue(etag)
+        resp = self.fetch("/?%s" % qs, headers={"If-None-Match": etag})
+        self.assertEqual(resp.code, 304)
+
+    def test_valid_repeated_operation(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, op="rotate,rotate", deg=90, expand=1))
+        resp = self.fetch_success("/?%s" % qs)
+        expected_path = os.path.join(
+            os.path.dirname(__file__), "data", "expected",
+            "test1-rotate-degree=90-expand=1.jpg")
+        msg = "/?%s does not match %s" % (qs, expected_path)
+        with open(expected_path, "rb") as expected:
+            self.assertEqual(resp.buffer.read(), expected.read(), msg)
+
     def test_valid_resize(self):
         cases = self.get_image_resize_cases()
         for case in cases:
@@ -437,6 +525,19 @@ class AppImplicitBaseUrlTest(AsyncHTTPTestCase, _AppAsyncMixin):
         self.assertEqual(resp.get("error_code"), errors.UrlError.get_code())
 
 
+class AppExtensionTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _CustomTestApplication()
+
+    def test_valid_custom_handler(self):
+        url = self.get_url("/test/data/test1.jpg")
+        resp = self.fetch_success("/100x100/%s" % url)
+        expected = self.fetch_success(
+            "/?%s" % urlencode(dict(url=url, w=100, h=100)))
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        self.assertEqual(resp.body, expected.body)
+
+
 class AppAllowedOperationsTest(AsyncHTTPTestCase, _AppAsyncMixin):
     def get_app(self):
         return _PilboxTestApplication(allowed_operations=['noop'])
@@ -555,12 +656,30 @@ class AppRestrictedTest(AsyncHTTPTestCase, _AppAsyncMixin):
         self.assertEqual(resp.get("error_code"),
                          errors.SignatureError.get_code())
 
+    def test_repeated_signature(self):
+        url = self.get_url("/test/data/test1.jpg")
+        params = dict(url=url, w=1, h=1, client=self.NAME)
+        qs = sign(self.KEY, urlencode(params))
+        bad_qs = urlencode(dict(params, sig="abc123"))
+        for _ in range(2):
+            self.fetch_success("/?%s" % qs)
+            resp = self.fetch_error(403, "/?%s" % bad_qs)
+            self.assertEqual(resp.get("error_code"),
+                             errors.SignatureError.get_code())
+
     def test_bad_host(self):
         params = dict(url="http://bar.co/x.jpg", w=1, h=1, client=self.NAME)
         qs = sign(self.KEY, urlencode(params))
         resp = self.fetch_error(403, "/?%s" % qs)
         self.assertEqual(resp.get("error_code"), errors.HostError.get_code())
 
+    def test_bad_host_with_userinfo(self):
+        params = dict(url="http://foo.co:a@bar.co:80/x.jpg", w=1, h=1,
+                      client=self.NAME)
+        qs = sign(self.KEY, urlencode(params))
+        resp = self.fetch_error(403, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.HostError.get_code())
+
     def test_valid(self):
         cases = self.get_image_resize_cases()
         for case in cases:
@@ -576,6 +695,25 @@ class AppRestrictedTest(AsyncHTTPTestCase, _AppAsyncMixin):
                 self.assertEqual(resp.buffer.read(), expected.read(), msg)
 
 
+class AppRestrictedImplicitBaseUrlTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    KEY = "abcdef"
+    NAME = "abc"
+
+    def get_app(self):
+        return _PilboxTestApplication(
+            client_name=self.NAME,
+            client_key=self.KEY,
+            allowed_hosts=["foo.co"],
+            implicit_base_url=self.get_url("/"))
+
+    def test_bad_host_in_path(self):
+        params = dict(url="/test/data/test1.jpg?u=http://foo.co/", w=1, h=1,
+                      client=self.NAME)
+        qs = sign(self.KEY, urlencode(params))
+        resp = self.fetch_error(403, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.HostError.get_code())
+
+
 class AppSlowTest(AsyncHTTPTestCase, _AppAsyncMixin):
     def get_app(self):
         return _PilboxTestApplication(timeout=0.5)
@@ -185,6 +185,16 @@ class ImageTest(unittest.TestCase):
         self.assertRaises(
             errors.DimensionsError, Image.validate_dimensions, "", "")
 
+    def test_invalid_dimensions_zero(self):
+        self.assertRaises(
+            errors.DimensionsError, Image.validate_dimensions, "0", 100)
+        self.assertRaises(
+            errors.DimensionsError, Image.validate_dimensions, 100, "00")
+        self.assertRaises(
+            errors.DimensionsError, Image.validate_dimensions, 0, 100)
+        self.assertRaises(
+            errors.DimensionsError, Image.validate_dimensions, 100, 0)
+
     def test_invalid_dimensions_not_integer(self):
         self.assertRaises(
             errors.DimensionsError, Image.validate_dimensions, "a", 100)